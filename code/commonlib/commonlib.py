@@ -5,10 +5,203 @@
 """Defines common classes and modules."""
 import logging
 import re
-import sys
+import time
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+logger = logging.getLogger(__name__)
+
+# Boto3 clients, shared across warm invocations.
+# Creating clients is expensive, so they are built once at import time.
+_CONFIG = Config(
+    max_pool_connections=25,
+    retries={"mode": "adaptive", "total_max_attempts": 5},
+    connect_timeout=3,
+    read_timeout=10,
+    tcp_keepalive=True,
+)
+_ECS = boto3.client("ecs", config=_CONFIG)
+_EC2 = boto3.client("ec2", config=_CONFIG)
+_SSM = boto3.client("ssm", config=_CONFIG)
+_SNS = boto3.client("sns", config=_CONFIG)
+
+# EC2 Instance IDs, any other node ID belongs to an ECS Anywhere node
+_EC2_ID_RE = re.compile(r"^i-(?:[a-f\d]{8}|[a-f\d]{17})$")
+
+# Cluster tags rarely change, cache them across warm invocations
+CLUSTER_TAGS_TTL_SECONDS = 60
+_cluster_tags_cache = {}
+
+
+def fetch_container_instances(cluster_nodes: dict) -> dict:
+    """Fetches the ECS Container Instances, with a single API call per ECS Cluster.
+
+    Args:
+        cluster_nodes (Dictionary): ECS Container Instance ARNs, grouped by ECS Cluster ARN.
+
+    Returns:
+        Dictionary : ECS Container Instances, indexed by Container Instance ARN.
+        Container Instances not found (e.g. deregistered, or from a deleted Cluster) are left out.
+    """
+    container_instances = {}
+    try:
+        for ecs_cluster, node_ecs_arns in cluster_nodes.items():
+            # The API accepts up to 100 Container Instances per call
+            for index in range(0, len(node_ecs_arns), 100):
+                try:
+                    response = _ECS.describe_container_instances(
+                        cluster=ecs_cluster,
+                        containerInstances=node_ecs_arns[index:index + 100],
+                    )
+                except ClientError as error:
+                    if error.response.get("Error", {}).get("Code") != "ClusterNotFoundException":
+                        raise
+                    logger.info("ECS Cluster [%s] not found, skipping its Container Instances.", ecs_cluster)
+                    break
+
+                if response["failures"]:
+                    logger.info("Container Instances not found, skipping them: %s", response["failures"])
+
+                for container_instance in response["containerInstances"]:
+                    container_instances[container_instance["containerInstanceArn"]] = container_instance
+
+        return container_instances
+
+    except ClientError as error:
+        code = error.response.get("Error", {}).get("Code")
+        message = error.response.get("Error", {}).get("Message")
+        logger.error("An error occurred when fetching container instances - %s : %s", code, message)
+        raise
+
+
+def fetch_instance_statuses(node_ids: list) -> dict:
+    """Fetches the state of the given nodes, with a single API call for the EC2 Instances
+    and another one for the ECS Anywhere nodes.
+
+    Args:
+        node_ids (list): Node IDs, as reported by the ECS Container Instances.
+
+    Returns:
+        Dictionary : Node states ('running' when the node is available), indexed by node ID.
+        Every requested node is present, those not found are reported as 'not-running'.
+    """
+    instance_ids = sorted({node_id for node_id in node_ids if _EC2_ID_RE.match(node_id)})
+    managed_ids = sorted({node_id for node_id in node_ids if not _EC2_ID_RE.match(node_id)})
+
+    try:
+        instance_statuses = {}
+        # These are EC2 Instances, retrieve the state. Filtering by ID (instead of using InstanceIds)
+        # does not fail the whole call with InvalidInstanceID.NotFound when one of them is gone.
+        # The filter accepts up to 200 values.
+        for index in range(0, len(instance_ids), 200):
+            pages = _EC2.get_paginator("describe_instances").paginate(
+                Filters=[
+                    {"Name": "instance-id", "Values": instance_ids[index:index + 200]},
+                ],
+            )
+            for page in pages:
+                for reservation in page["Reservations"]:
+                    for instance in reservation["Instances"]:
+                        instance_statuses[instance["InstanceId"]] = instance["State"]["Name"]
+
+        # These are ECS Anywhere nodes, retrieve the state. The filter accepts up to 50 IDs.
+        for index in range(0, len(managed_ids), 50):
+            pages = _SSM.get_paginator("describe_instance_information").paginate(
+                Filters=[
+                    {"Key": "InstanceIds", "Values": managed_ids[index:index + 50]},
+                ],
+            )
+            for page in pages:
+                for instance_information in page["InstanceInformationList"]:
+                    if instance_information["PingStatus"] == "Online":
+                        instance_statuses[instance_information["InstanceId"]] = "running"
+                    else:
+                        instance_statuses[instance_information["InstanceId"]] = "not-running"
+
+        # Nodes not found (e.g. terminated or deregistered) are not running
+        for node_id in instance_ids + managed_ids:
+            if node_id not in instance_statuses:
+                logger.info("Node [%s] not found, considering it not running.", node_id)
+                instance_statuses[node_id] = "not-running"
+
+        return instance_statuses
+
+    except ClientError as error:
+        code = error.response.get("Error", {}).get("Code")
+        message = error.response.get("Error", {}).get("Message")
+        logger.error("An error occurred when fetching instance details - %s : %s", code, message)
+        raise
+
+
+def fetch_cluster_tags(cluster_arns: list) -> dict:
+    """Fetches the tags of the ECS Clusters, with a single API call for those not cached.
+    Tags are cached for CLUSTER_TAGS_TTL_SECONDS.
+
+    Args:
+        cluster_arns (list): ECS Cluster ARNs.
+
+    Returns:
+        Dictionary : ECS Cluster tags, indexed by Cluster ARN. Clusters not found have no tags.
+    """
+    now = time.monotonic()
+    expired_arns = [
+        cluster_arn for cluster_arn in dict.fromkeys(cluster_arns)
+        if now - _cluster_tags_cache.get(cluster_arn, (float("-inf"), None))[0] > CLUSTER_TAGS_TTL_SECONDS
+    ]
+    try:
+        # The API accepts up to 100 Clusters per call
+        for index in range(0, len(expired_arns), 100):
+            response = _ECS.describe_clusters(
+                clusters=expired_arns[index:index + 100],
+                include=["TAGS"],
+            )
+            if response["failures"]:
+                logger.info("ECS Clusters not found, considering them without tags: %s", response["failures"])
+                for failure in response["failures"]:
+                    _cluster_tags_cache[failure["arn"]] = (now, [])
+
+            for cluster in response["clusters"]:
+                _cluster_tags_cache[cluster["clusterArn"]] = (now, cluster.get("tags", []))
+
+        return {cluster_arn: _cluster_tags_cache[cluster_arn][1] for cluster_arn in cluster_arns}
+
+    except ClientError as error:
+        code = error.response.get("Error", {}).get("Code")
+        message = error.response.get("Error", {}).get("Message")
+        logger.error("An error occurred when checking Cluster tags - %s : %s", code, message)
+        raise
+
+
+def does_cluster_have_tags(cluster_arn: str, tag_key=None, tag_value=None) -> bool:
+    """Check if the Cluster has a specific Tag.
+
+    Args:
+        cluster_arn (String): ECS Cluster ARN.
+        tag_key (String, optional): Tag key to check. Defaults to None.
+        tag_value (String, optional): Tag value to check. Defaults to None.
+
+    Returns:
+        Boolean : True/False depending on if the tag was found or not.
+    """
+    if tag_key is None or tag_value is None:
+        return False
+
+    # Fetch cluster tags
+    cluster_tags = fetch_cluster_tags([cluster_arn])[cluster_arn]
+
+    # Check if tags match
+    logger.info("Checking ECS cluster: [%s]", cluster_arn)
+    logger.info("Looking for -> Tag key: [%s] - Tag value: [%s]", tag_key, tag_value)
+    logger.info("Cluster Tags: %s", cluster_tags)
+
+    if any(element["key"] == tag_key and element["value"] == tag_value for element in cluster_tags):
+        logger.info("Found tag: [%s] = [%s]", tag_key, tag_value)
+        return True
+
+    logger.info("ECS Cluster tags do not match. 'MonitorByTag' was enabled but this Cluster is not enabled for monitoring.")
+    return False
+
 
 class ECSNode:
     """Represents an ECS Container Instance, with all the inherited properties.
@@ -22,81 +215,39 @@ class ECSNode:
         ContainerInstance: An instance of an ECS Container Instance object.
     """
 
-    def __init__(self, node_ecs_arn: str, ecs_cluster: str):
-        """Fetch and populate all the properties.
+    __slots__ = ("ec2_id", "instance_status", "agent_connected", "cluster_arn")
+
+    def __init__(self, container_instance: dict, ecs_cluster: str, instance_statuses: dict):
+        """Populate all the properties from the already fetched Container Instance.
 
         Args:
-            ec2_ecs_arn (String): ECS Container Instance ARN. Defaults to None.
+            container_instance (Dictionary): ECS Container Instance, as returned by describe_container_instances.
             ecs_cluster (String): ECS Cluster. Defaults to None.
+            instance_statuses (Dictionary): Node states indexed by node ID.
         """
-        # Logging
-        sys.tracebacklimit = 0
-        self.logger = logging.getLogger()
-        self.logger.setLevel(logging.INFO)
-
-        # Boto3 clients
-        self.ecs_client = boto3.client("ecs")
-        self.ec2_client = boto3.client("ec2")
-        self.ssm_client = boto3.client("ssm")
-
         # Set Node properties (can be an EC2 Instance or an ECS Anywhere node)
         (
             self.ec2_id,
             self.instance_status,
             self.agent_connected,
-        ) = self.fetch_ec2_details(node_ecs_arn, ecs_cluster)
+        ) = self.fetch_ec2_details(container_instance, instance_statuses)
         self.cluster_arn = ecs_cluster
 
-    def fetch_ec2_details(self, node_ecs_arn: str, ecs_cluster: str):
-        """Fetches and populates EC2 properties that must be retrieved from AWS API.
+    def fetch_ec2_details(self, container_instance: dict, instance_statuses: dict):
+        """Populates the node properties from the already fetched AWS API responses.
 
         Args:
-            node_ecs_arn (String): ECS Container Instance ARN.
-            ecs_cluster (String): ECS Cluster.
+            container_instance (Dictionary): ECS Container Instance.
+            instance_statuses (Dictionary): Node states indexed by node ID.
 
         Returns:
             String : node_id, instance_status, agent_connected - Instance properties
         """
-        # Retrieve the ECS Node
-        try:
-            container_instance = self.ecs_client.describe_container_instances(
-                cluster=ecs_cluster,
-                containerInstances=[
-                    node_ecs_arn,
-                ],
-            )["containerInstances"][0]
-            node_id = container_instance["ec2InstanceId"]
-            agent_connected = container_instance["agentConnected"]
-            self.logger.info("Checking node [%s].", node_id)
-
-            if re.compile(r"^i-(?:[a-f\d]{8}|[a-f\d]{17})$").match(node_id):
-                # This is an EC2 Instance, retrieve the state
-                instance_status = self.ec2_client.describe_instances(
-                    InstanceIds=[node_id]
-                )["Reservations"][0]["Instances"][0]["State"]["Name"]
-
-            else:
-                # This is an ECS Anywhere node, retrieve the state
-                ping_status = self.ssm_client.describe_instance_information(
-                    Filters=[
-                        {"Key": "InstanceIds", "Values": [node_id]},
-                    ],
-                )["InstanceInformationList"][0]["PingStatus"]
-
-                if ping_status == "Online":
-                    instance_status = "running"
-                else:
-                    instance_status = "not-running"
-    
-            return node_id, instance_status, agent_connected
+        node_id = container_instance["ec2InstanceId"]
+        agent_connected = container_instance["agentConnected"]
+        logger.info("Checking node [%s].", node_id)
 
-        except ClientError as error:
-            code = error.response.get("Error", None).get("Code", None)
-            message = error.response.get("Error", None).get("Message", None)
-            raise Exception(f"Error: An error occurred when fetching instance details - {code} : {message}") from error
-        
-        except Exception as error:
-            raise Exception(f"Error: An error occurred when fetching instance details - {str(error)}") from error
+        return node_id, instance_statuses[node_id], agent_connected
 
     def get_ec2_item(self):
         """Return an EC2 JSON item suitable.
@@ -119,53 +270,9 @@ class ECSNode:
         if self.instance_status == "running":
             return True
 
-        self.logger.info("ECS Container Instance [%s] is not running anymore.", self.ec2_id)
+        logger.info("ECS Container Instance [%s] is not running anymore.", self.ec2_id)
         return False
 
-    def does_cluster_have_tags(self, tag_key=None, tag_value=None) -> bool:
-        """Check if the Cluster has a specific Tag.
-
-        Args:
-            tag_key (String, optional): Tag key to check. Defaults to None.
-            tag_value (String, optional): Tag value to check. Defaults to None.
-
-        Returns:
-            Boolean : True/False depending on if the tag was found or not.
-        """
-        if tag_key is None or tag_value is None:
-            return False
-
-        # Fetch cluster tags
-        try:
-            cluster_tags = self.ecs_client.describe_clusters(
-                clusters=[
-                    self.cluster_arn,
-                ],
-                include=["TAGS"],
-            )["clusters"][0]["tags"]
-
-            # Check if tags match
-            self.logger.info("Checking ECS cluster: [%s]", self.cluster_arn)
-            self.logger.info("Looking for -> Tag key: [%s] - Tag value: [%s]", tag_key, tag_value)
-            self.logger.info("Cluster Tags: %s", cluster_tags)
-
-            tag_result = [ element for element in cluster_tags if (element['key'] == tag_key and element['value'] == tag_value) ]
-
-            if tag_result:
-                self.logger.info("Found tags: %s", str(tag_result))
-                return True
-
-            self.logger.info("ECS Cluster tags do not match. 'MonitorByTag' was enabled but this Cluster is not enabled for monitoring.")
-            return False
-
-        except ClientError as error:
-            code = error.response.get("Error", None).get("Code", None)
-            message = error.response.get("Error", None).get("Message", None)
-            raise Exception(f"Error: An error occurred when checking Cluster tags - {code} : {message}") from error
-
-        except Exception as error:
-            raise Exception("Error: An error occurred when checking Cluster tags.") from error
-
     def is_agent_connected(self) -> bool:
         """Check if the ECS Agent has reconnected or not.
 
@@ -173,10 +280,10 @@ class ECSNode:
             Boolean : True/False depending on the ECS Agent state.
         """
         if self.agent_connected:
-            self.logger.info("ECS Agent for Container Instance [%s] is connected.", self.ec2_id)
+            logger.info("ECS Agent for Container Instance [%s] is connected.", self.ec2_id)
             return True
         else:
-            self.logger.info("ECS Agent for Container Instance [%s] remains with agentConnected status as false.", self.ec2_id)
+            logger.info("ECS Agent for Container Instance [%s] remains with agentConnected status as false.", self.ec2_id)
             return False
 
 
@@ -190,31 +297,36 @@ class SNSTopic:
         N / A.
     """
 
-    def __init__(self):
-
-        # Boto3 client
-        self.sns_client = boto3.client("sns")
-
-    def send_email(self, topic_arn=None, email_subject=None, email_body=None):
-        """Sends the notification email.
+    def send_emails(self, topic_arn=None, emails=None):
+        """Sends several notification emails, batching up to 10 per API call.
+        Batches are sent as the generator is consumed.
 
         Args:
             topic_arn (String, optional): Destination SNS topic.
-            email_subject (String, optional): Title for the email.
-            email_body (String, optional): Body for the email.
+            emails (list, optional): Tuples of (email_subject, email_body).
 
-        Returns:
-            Boolean : True/False depending on if the tag was found or not.
+        Yields:
+            list : The emails of each batch, once it was successfully published.
         """
+        emails = emails or []
+        entries = [
+            {"Id": str(index), "Subject": email_subject, "Message": email_body}
+            for index, (email_subject, email_body) in enumerate(emails)
+        ]
         try:
-            self.sns_client.publish(
-                TopicArn=topic_arn, Message=email_body, Subject=email_subject
-            )
+            # The API accepts up to 10 messages per call
+            for index in range(0, len(entries), 10):
+                response = _SNS.publish_batch(
+                    TopicArn=topic_arn,
+                    PublishBatchRequestEntries=entries[index:index + 10],
+                )
+                if response["Failed"]:
+                    raise ValueError(f"Messages not published: {response['Failed']}")
 
-        except ClientError as error:
-            code = error.response.get("Error", None).get("Code", None)
-            message = error.response.get("Error", None).get("Message", None)
-            raise Exception(f"Error: An error occurred when sending the e-mail - {code} : {message}") from error
+                yield emails[index:index + 10]
 
-        except Exception as error:
-            raise Exception(f"Error: An error occurred when sending the e-mail - {str(error)}") from error
+        except ClientError as error:
+            code = error.response.get("Error", {}).get("Code")
+            message = error.response.get("Error", {}).get("Message")
+            logger.error("An error occurred when sending the e-mails - %s : %s", code, message)
+            raise
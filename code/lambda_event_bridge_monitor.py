@@ -24,14 +24,41 @@ import json
 import logging
 import os
 import sys
-from commonlib.commonlib import ECSNode, SNSTopic
+from botocore.exceptions import ClientError
+from commonlib.commonlib import (
+    ECSNode,
+    SNSTopic,
+    does_cluster_have_tags,
+    fetch_cluster_tags,
+    fetch_container_instances,
+    fetch_instance_statuses,
+)
 
 sys.tracebacklimit = 0
 
+# orjson parses the SQS bodies faster, when it is shipped with the function
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 # create logger
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+_TRUTHY = frozenset({"true", "yes", "1", "on"})
+
+# Settings, they do not change during the lifetime of the Lambda execution environment
+TAG_KEY = os.environ.get("monitoringTagKeyName", None)
+TAG_VALUE = os.environ.get("monitoringTagKeyValue", None)
+CHECK_ALL_CLUSTERS = os.environ.get("checkAllClusters", "false").lower() in _TRUTHY
+EMAIL_TOPIC_ARN = os.environ.get("sendEmailNotification", None)
+
+# E-mail notification templates
+NOTIFICATION_SUBJECT = "[ISSUE] ECS Instance - %s"
+NOTIFICATION_TEXT = "[ISSUE] ECS Container Instance %s from Cluster %s has the ECS Agent disconnected."
+NOTIFICATION_LOG = "Sending email notification: " + NOTIFICATION_TEXT
+
 
 def custom_actions(expired_instance):
     """Allow the end user to implement any custom/personalized action and/or
@@ -43,6 +70,58 @@ def custom_actions(expired_instance):
     pass
 
 
+def process_record(
+    payload,
+    container_instances,
+    instance_statuses,
+    already_processed_nodes,
+):
+    """Check a single ECS Event, and decide if the ECS Agent disconnection must be notified.
+
+    Args:
+        payload JSON: ECS Container Instance State Change event.
+        container_instances (Dictionary): ECS Container Instances, indexed by Container Instance ARN.
+        instance_statuses (Dictionary): Node states, indexed by node ID.
+        already_processed_nodes (set): Node IDs already notified in this invocation.
+
+    Returns:
+        Dictionary : The EC2 item to send a notification for, None otherwise.
+    """
+    # Create EC2 Instance object
+    detail = payload["detail"]
+    ecs_instance = ECSNode(
+        container_instances[detail["containerInstanceArn"]],
+        detail["clusterArn"],
+        instance_statuses,
+    )
+
+    ec2_item = ecs_instance.get_ec2_item()
+
+    # The Cluster is already known to be enabled for monitoring (cluster tags).
+    # For the instance to be checked, it needs to meet 2 more conditions:
+    # 1. Is the ECS Container Instance running?
+    # 2. Is the ECS Agent still disconnected?
+    if ecs_instance.is_ec2_running() and not ecs_instance.is_agent_connected():
+        # Store the node ID, as we will re-using it many times
+        node_id = ec2_item['ec2InstanceId']
+
+        if node_id in already_processed_nodes:
+            logger.info("Avoiding duplicated alerts, [%s] has already been processed.", node_id)
+
+        else:
+            # Record the node ID, for avoiding future duplicates
+            already_processed_nodes.add(node_id)
+
+            # The e-mail notification, metric and custom actions are handled once all records are checked
+            return ec2_item
+    else:
+        logger.info(
+            "Container Instance %s does not need to be checked. Execution successful!",
+            ec2_item["ec2InstanceId"],
+        )
+    return None
+
+
 def handler(event, context):
     """Main function handler. The AWS Lambda function will receive ECS Events from
     AWS EventBridge, via an SQS Queue.
@@ -61,20 +140,15 @@ def handler(event, context):
        ValueError: Missing values or mandatory properties.
     """
     try:
-        tag_key = os.environ.get("monitoringTagKeyName", None)
-        tag_value = os.environ.get("monitoringTagKeyValue", None)
-        check_all_clusters = os.environ.get("checkAllClusters", 'false')
-        email_notification = os.environ.get("sendEmailNotification", False)
-
         logger.info("Start processing the event.")
 
         # Iterate over all the possible received events (SQS Messages)
-        already_processed_nodes = []
+        payloads = []
         for record in event["Records"]:
             logger.info("Processing new record.")
 
             # Obtain payload
-            payload = json.loads(record.get("body", None))
+            payload = json_loads(record["body"])
 
             # Sanity checks
             if payload is None:
@@ -88,74 +162,86 @@ def handler(event, context):
                     "Only 'aws.ecs' events and Instance state changes are supported."
                 )
 
-            if (
-                payload["detail"]["agentConnected"] is not False
-                or payload["detail"]["status"] != "ACTIVE"
-            ):
+            # Skip only this record, the remaining ones still need to be processed
+            detail = payload["detail"]
+            if detail["agentConnected"] is not False or detail["status"] != "ACTIVE":
                 logger.info(
                     "Instance does not need to be processed (reconnected or not ACTIVE)."
                 )
-                return
-
-            # Create EC2 Instance object
-            ecs_instance = ECSNode(
-                payload.get("detail", None).get("containerInstanceArn", None),
-                payload.get("detail", None).get("clusterArn", None),
-            )
-
-            # For the instance to be checked, it needs to meet 3 conditions:
-            # 1. Is the Instance enabled for monitoring (cluster tags)?
-            # 2. Is the ECS Container Instance running?
-            # 3. Is the ECS Agent still disconnected?
-            if (
+                continue
+
+            payloads.append(payload)
+
+        # Group the Container Instances per Cluster, so that they are fetched in batches.
+        # Dictionary keys keep the ARNs unique and in order.
+        cluster_nodes = {}
+        for payload in payloads:
+            detail = payload["detail"]
+            cluster_nodes.setdefault(detail["clusterArn"], {})[detail["containerInstanceArn"]] = None
+        cluster_nodes = {cluster_arn: list(node_ecs_arns) for cluster_arn, node_ecs_arns in cluster_nodes.items()}
+
+        # Discard the Clusters not enabled for monitoring, before fetching any node details
+        if not CHECK_ALL_CLUSTERS:
+            if TAG_KEY is not None and TAG_VALUE is not None:
+                # Warm up the Cluster tags cache with a single call for the whole batch
+                fetch_cluster_tags(list(cluster_nodes))
+
+            cluster_nodes = {
+                cluster_arn: node_ecs_arns
+                for cluster_arn, node_ecs_arns in cluster_nodes.items()
+                if does_cluster_have_tags(cluster_arn, tag_key=TAG_KEY, tag_value=TAG_VALUE)
+            }
+            payloads = [payload for payload in payloads if payload["detail"]["clusterArn"] in cluster_nodes]
+
+        container_instances = fetch_container_instances(cluster_nodes)
+        payloads = [payload for payload in payloads if payload["detail"]["containerInstanceArn"] in container_instances]
+        instance_statuses = fetch_instance_statuses(
+            [container_instance["ec2InstanceId"] for container_instance in container_instances.values()]
+        )
+
+        # AWS lookups are already batched, so the records are checked sequentially (in order)
+        already_processed_nodes = set()
+        notifications = []
+        for payload in payloads:
+            notification = process_record(payload, container_instances, instance_statuses, already_processed_nodes)
+            if notification is not None:
+                notifications.append(notification)
+
+        # Send the e-mail notifications in batches. The metric and the custom actions only follow
+        # a successfully sent batch. If a later batch fails, the whole SQS batch is redelivered,
+        # and the notifications, metrics and custom actions of the earlier batches are repeated.
+        # These repeats are accepted.
+        for ec2_item in notifications:
+            logger.info(NOTIFICATION_LOG, ec2_item["ec2InstanceId"], ec2_item["clusterArn"])
+
+        email_handler = SNSTopic()
+        sent = 0
+        for batch in email_handler.send_emails(
+            topic_arn=EMAIL_TOPIC_ARN,
+            emails=[
                 (
-                    check_all_clusters.lower() in ['true', 'yes']
-                    or ecs_instance.does_cluster_have_tags(
-                        tag_key=tag_key, tag_value=tag_value
-                    )
+                    NOTIFICATION_SUBJECT % ec2_item["ec2InstanceId"],
+                    NOTIFICATION_TEXT % (ec2_item["ec2InstanceId"], ec2_item["clusterArn"]),
                 )
-                and ecs_instance.is_ec2_running()
-                and not ecs_instance.is_agent_connected()
-            ):
-                # Store the node ID, as we will re-using it many times
-                node_id = ecs_instance.get_ec2_item()['ec2InstanceId']
-
-                if node_id in already_processed_nodes:
-                    logger.info("Avoiding duplicated alerts, [%s] has already been processed.", node_id)
-
-                else:
-                    # Record the node ID, for avoiding future duplicates
-                    already_processed_nodes.append(node_id)
-
-                    # Sending the e-mail notification
-                    notification_text = (
-                        f"[ISSUE] ECS Container Instance {node_id}"
-                        f" from Cluster {ecs_instance.get_ec2_item()['clusterArn']}"
-                        f" has the ECS Agent disconnected."
-                    )
-
-                    logger.info("Sending email notification: %s", notification_text)
-                    email_handler = SNSTopic()
-                    email_handler.send_email(
-                        topic_arn=email_notification,
-                        email_subject=f"[ISSUE] ECS Instance - {node_id}",
-                        email_body=notification_text,
-                    )
-                    # This log entry generates the CloudWatch metric
-                    logger.warning(
-                        "%s %s",
-                        str(ecs_instance.get_ec2_item()["clusterArn"]).rsplit("/", 1)[1],
-                        ecs_instance.get_ec2_item()["ec2InstanceId"],
-                    )
-
-                    # Execute custom actions
-                    custom_actions(ecs_instance.get_ec2_item())
-            else:
-                logger.info(
-                    "Container Instance %s does not need to be checked. Execution successful!",
-                    ecs_instance.get_ec2_item()["ec2InstanceId"],
+                for ec2_item in notifications
+            ],
+        ):
+            for ec2_item in notifications[sent:sent + len(batch)]:
+                # This log entry generates the CloudWatch metric
+                logger.warning(
+                    "%s %s",
+                    ec2_item["clusterArn"].rpartition("/")[2],
+                    ec2_item["ec2InstanceId"],
                 )
+
+                # Execute custom actions
+                custom_actions(ec2_item)
+            sent += len(batch)
         return
 
+    except ClientError:
+        # AWS API errors are propagated as-is, after the boto3 retries were exhausted
+        raise
+
     except Exception as error:
         raise Exception(f"Error: execution error - {str(error)}") from error